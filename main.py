@@ -6,6 +6,8 @@ import pygame as pg
 from modules.texture import WallTexture
 from modules.texture import FloorTexture
 from modules.renderer import Camera
+from modules.minimap import Minimap
+from modules.palette import Palette
 from modules.entities import Player
 from modules.entities import EntityManager
 
@@ -26,6 +28,8 @@ class Game(object):
 
         self._settings = {
             'vsync': 1,
+            'minimap': 1,
+            'indexed_color': 0,
         }
         self._screen = pg.display.set_mode(
             self._SCREEN_SIZE,
@@ -59,13 +63,22 @@ class Game(object):
                 '5;11': 0, '6;11': 0, '7;11': 0, '8;11': 0,
                 '9;11': 0, '10;11': 0,
             },
+            # optional, in tiles; walls default to a height of 1 on the floor
+            # and negative offsets sink them into it
+            'heights': {},
+            'floor_offsets': {},
         }
 
         self._wall_textures = [
             WallTexture('data/images/greystone.png'),
         ]
         self._floor_texture = FloorTexture('data/images/redbrick.png')
-        
+        self._palette = None
+        if self._settings['indexed_color']:
+            self._palette = Palette(
+                [texture.surf for texture in self._wall_textures]
+                + [self._floor_texture.surf]
+            )
         
         self._player = Player(self._level)
         self._camera = Camera(
@@ -75,9 +88,16 @@ class Game(object):
             self._wall_textures,
             self._floor_texture,
             self._player,
+            palette=self._palette,
         )
         self._player.pos = (6.5, 6)
         self._camera.horizon = self._SURF_SIZE[1] / 2
+        self._minimap = Minimap(
+            self._level,
+            4,
+            self._wall_textures,
+            show_rays=1,
+        )
         self._level_timer = 0
     
     def run(self: Self) -> None:
@@ -95,14 +115,21 @@ class Game(object):
             for event in pg.event.get():
                 if event.type == pg.QUIT:
                     self._running = 0
+                elif event.type == pg.KEYDOWN and event.key == pg.K_m:
+                    self._settings['minimap'] = not self._settings['minimap']
                 self._player.handle_events(event)
 
             self._player.update(rel_game_speed, self._level_timer)
             self._camera.render(self._surface)
+            if self._settings['minimap']:
+                self._minimap.render(self._surface,
+                                     (4, 4),
+                                     self._player,
+                                     camera=self._camera)
             pg.display.set_caption(str(1 / delta_time))
 
-            resized_surf = pg.transform.scale(self._surface, self._SCREEN_SIZE)
-            self._screen.blit(resized_surf, (0, 0))
+            # scales straight into the display instead of a new surface
+            pg.transform.scale(self._surface, self._SCREEN_SIZE, self._screen)
 
             pg.display.update()
 
@@ -0,0 +1,205 @@
+from typing import Self
+from collections.abc import Sequence
+
+import pygame as pg
+from pygame.typing import Point
+from pygame.typing import ColorLike
+
+from modules.texture import WallTexture
+from modules.entities import Entity
+from modules.entities import Player
+from modules.renderer import Camera
+
+
+class Minimap(object):
+    def __init__(self: Self,
+                 level: dict,
+                 tile_size: int=4,
+                 wall_textures: Sequence[WallTexture] | None=None,
+                 wall_color: ColorLike=(200, 200, 200),
+                 floor_color: ColorLike=(0, 0, 0),
+                 player_color: ColorLike=(255, 255, 0),
+                 entity_color: ColorLike=(255, 0, 0),
+                 ray_color: ColorLike=(255, 255, 255, 48),
+                 show_rays: bool=0) -> None:
+        self._level = level
+        self._tile_size = max(int(tile_size), 1)
+        self._dirty = set()
+        self._ray_layer = None
+        self._settings = {
+            'wall_color': pg.Color(wall_color),
+            'floor_color': pg.Color(floor_color),
+            'player_color': pg.Color(player_color),
+            'entity_color': pg.Color(entity_color),
+            'ray_color': pg.Color(ray_color),
+        }
+        self.wall_textures = wall_textures
+        self.show_rays = show_rays
+
+    @property
+    def level(self: Self) -> dict:
+        return self._level
+
+    @level.setter
+    def level(self: Self, value: dict) -> None:
+        self._level = value
+        self.rebuild()
+
+    @property
+    def tile_size(self: Self) -> int:
+        return self._tile_size
+
+    @tile_size.setter
+    def tile_size(self: Self, value: int) -> None:
+        self._tile_size = max(int(value), 1)
+        self.rebuild()
+
+    @property
+    def wall_textures(self: Self) -> Sequence[WallTexture] | None:
+        return self._wall_textures
+
+    @wall_textures.setter
+    def wall_textures(self: Self,
+                      value: Sequence[WallTexture] | None) -> None:
+        # each wall is drawn as the average color of its texture
+        self._wall_textures = value
+        self._texture_colors = []
+        if value != None:
+            self._texture_colors = [
+                pg.Color(pg.transform.average_color(texture.surf)[:3])
+                for texture in value
+            ]
+        self.rebuild()
+
+    @property
+    def show_rays(self: Self) -> bool:
+        return bool(self._settings['show_rays'])
+
+    @show_rays.setter
+    def show_rays(self: Self, value: bool) -> None:
+        self._settings['show_rays'] = value
+
+    @property
+    def surf(self: Self) -> pg.Surface:
+        self._redraw_dirty()
+        return self._surf
+
+    @property
+    def size(self: Self) -> tuple:
+        return self._surf.size
+
+    def rebuild(self: Self) -> None:
+        # rasterizes the whole wall grid; only needed when the level's bounds
+        # or the look of the map change
+        tiles = [tuple(map(int, key.split(';')))
+                 for key in self._level['walls']]
+        if tiles:
+            self._origin = (min(tile[0] for tile in tiles),
+                            min(tile[1] for tile in tiles))
+            self._tiles_size = (
+                max(tile[0] for tile in tiles) - self._origin[0] + 1,
+                max(tile[1] for tile in tiles) - self._origin[1] + 1,
+            )
+        else:
+            self._origin = (0, 0)
+            self._tiles_size = (1, 1)
+        self._surf = pg.Surface((self._tiles_size[0] * self._tile_size,
+                                 self._tiles_size[1] * self._tile_size))
+        self._surf.fill(self._settings['floor_color'])
+        for tile in tiles:
+            self._draw_tile(*tile)
+        self._dirty.clear()
+
+    def mark_dirty(self: Self, *keys: str) -> None:
+        # call with the 'x;y' keys of any walls added, removed or retextured
+        self._dirty.update(keys)
+
+    def _draw_tile(self: Self, tile_x: int, tile_y: int) -> None:
+        texture = self._level['walls'].get(f'{tile_x};{tile_y}')
+        if texture == None:
+            color = self._settings['floor_color']
+        elif texture < len(self._texture_colors):
+            color = self._texture_colors[texture]
+        else:
+            color = self._settings['wall_color']
+        self._surf.fill(color, pg.Rect(
+            (tile_x - self._origin[0]) * self._tile_size,
+            (tile_y - self._origin[1]) * self._tile_size,
+            self._tile_size,
+            self._tile_size,
+        ))
+
+    def _redraw_dirty(self: Self) -> None:
+        if not self._dirty:
+            return
+        tiles = [tuple(map(int, key.split(';'))) for key in self._dirty]
+        for tile_x, tile_y in tiles:
+            if not (0 <= tile_x - self._origin[0] < self._tiles_size[0]
+                    and 0 <= tile_y - self._origin[1] < self._tiles_size[1]):
+                # a wall outside the old bounds grows the map
+                self.rebuild()
+                return
+        for tile in tiles:
+            self._draw_tile(*tile)
+        self._dirty.clear()
+
+    def to_map(self: Self, pos: Point, dest: Point=(0, 0)) -> tuple:
+        return (dest[0] + (pos[0] - self._origin[0]) * self._tile_size,
+                dest[1] + (pos[1] - self._origin[1]) * self._tile_size)
+
+    def render(self: Self,
+               surf: pg.Surface,
+               dest: Point=(0, 0),
+               player: Player | None=None,
+               entities: Sequence[Entity]=(),
+               camera: Camera | None=None) -> None:
+        self._redraw_dirty()
+        surf.blit(self._surf, dest)
+        clip = surf.get_clip()
+        surf.set_clip(pg.Rect(dest, self._surf.size).clip(clip))
+
+        if camera != None and self._settings['show_rays']:
+            ray_ends = camera.ray_ends
+            if player == None:
+                player = camera.player
+            if ray_ends:
+                # the whole view cone as one polygon instead of a line per ray
+                points = [self.to_map(player._pos, dest)]
+                points.extend(self.to_map(end, dest) for end in ray_ends)
+                color = self._settings['ray_color']
+                if color.a == 255:
+                    pg.draw.polygon(surf, color, points)
+                else:
+                    # draw.polygon doesn't blend, so go through a layer
+                    # the size of the minimap, kept between frames
+                    bounds = pg.Rect(surf.get_clip())
+                    layer = self._ray_layer
+                    if layer == None or layer.size != bounds.size:
+                        layer = pg.Surface(bounds.size, pg.SRCALPHA)
+                        self._ray_layer = layer
+                    else:
+                        layer.fill((0, 0, 0, 0))
+                    pg.draw.polygon(
+                        layer,
+                        color,
+                        [(x - bounds.x, y - bounds.y) for x, y in points],
+                    )
+                    surf.blit(layer, bounds)
+
+        radius = max(self._tile_size / 4, 1)
+        for entity in entities:
+            pg.draw.circle(surf, self._settings['entity_color'],
+                           self.to_map(entity._pos, dest), radius)
+
+        if player != None:
+            center = self.to_map(player._pos, dest)
+            pg.draw.circle(surf, self._settings['player_color'],
+                           center, radius)
+            pg.draw.line(
+                surf,
+                self._settings['player_color'],
+                center,
+                self.to_map(player._pos + player._yaw, dest),
+            )
+
+        surf.set_clip(clip)
@@ -0,0 +1,340 @@
+import math
+from typing import Self
+from numbers import Real
+from threading import Thread
+from collections import deque
+from collections import OrderedDict
+from collections.abc import Sequence
+
+import numpy as np
+import pygame as pg
+from pygame.typing import Point
+
+from modules.entities import Entity
+
+UNREACHABLE = np.iinfo(np.int32).max
+
+# checked in this order, so straight moves win ties against diagonals
+DIRECTIONS = (
+    (1, 0), (-1, 0), (0, 1), (0, -1),
+    (1, 1), (-1, 1), (1, -1), (-1, -1),
+)
+
+
+def _shift(array: np.ndarray, dx: int, dy: int, fill: object) -> np.ndarray:
+    # shifted[x, y] = array[x + dx, y + dy]
+    shifted = np.full_like(array, fill)
+    width, height = array.shape
+    shifted[max(-dx, 0):width - max(dx, 0),
+            max(-dy, 0):height - max(dy, 0)] = (
+        array[max(dx, 0):width - max(-dx, 0),
+              max(dy, 0):height - max(-dy, 0)]
+    )
+    return shifted
+
+
+class NavigationGrid(object):
+    def __init__(self: Self, level: dict) -> None:
+        self.level = level
+
+    @property
+    def level(self: Self) -> dict:
+        return self._level
+
+    @level.setter
+    def level(self: Self, value: dict) -> None:
+        self._level = value
+        self.rebuild()
+
+    @property
+    def origin(self: Self) -> tuple:
+        return self._origin
+
+    @property
+    def size(self: Self) -> tuple:
+        return self._walls.shape
+
+    @property
+    def walls(self: Self) -> np.ndarray:
+        return self._walls
+
+    @property
+    def stride(self: Self) -> int:
+        # distance between vertical neighbours in the padded flat grid
+        return self._walls.shape[1] + 2
+
+    def rebuild(self: Self) -> None:
+        # turns the level['walls'] dict into a boolean array indexed [x, y]
+        # (the same order as pg.surfarray) so fields can be built with numpy
+        tiles = [tuple(map(int, key.split(';')))
+                 for key in self._level['walls']]
+        if not tiles:
+            self._origin = (0, 0)
+            self._walls = np.zeros((1, 1), dtype=bool)
+        else:
+            tiles = np.array(tiles)
+            min_x, min_y = tiles.min(axis=0)
+            max_x, max_y = tiles.max(axis=0)
+            self._origin = (int(min_x), int(min_y))
+            self._walls = np.zeros((max_x - min_x + 1, max_y - min_y + 1),
+                                   dtype=bool)
+            self._walls[tiles[:, 0] - min_x, tiles[:, 1] - min_y] = 1
+        # a flat copy with a border of walls, so the BFS can step to
+        # neighbours without bounds checks
+        padded = np.zeros((self._walls.shape[0] + 2,
+                           self._walls.shape[1] + 2), dtype=bool)
+        padded[1:-1, 1:-1] = ~self._walls
+        self._passable = padded.ravel().tolist()
+
+    def to_flat(self: Self, grid_x: int, grid_y: int) -> int:
+        return (grid_x + 1) * self.stride + grid_y + 1
+
+    def to_grid(self: Self, x: object, y: object) -> tuple:
+        # works for both single values and arrays of world positions
+        return (np.floor(x).astype(int) - self._origin[0],
+                np.floor(y).astype(int) - self._origin[1])
+
+    def in_bounds(self: Self, grid_x: object, grid_y: object) -> object:
+        width, height = self._walls.shape
+        return ((0 <= grid_x) & (grid_x < width)
+                & (0 <= grid_y) & (grid_y < height))
+
+
+class FlowField(object):
+    def __init__(self: Self,
+                 grid: NavigationGrid,
+                 goal: Point,
+                 previous: Self | None=None) -> None:
+        self._grid = grid
+        # the walls this was built from; rebuilding the grid replaces them
+        self._passable = grid._passable
+        self._goal = (math.floor(goal[0]), math.floor(goal[1]))
+        self._build(previous)
+
+    @property
+    def goal(self: Self) -> tuple:
+        return self._goal
+
+    @property
+    def distances(self: Self) -> np.ndarray:
+        return self._distances
+
+    @property
+    def directions(self: Self) -> np.ndarray:
+        return self._directions
+
+    def _build(self: Self, previous: Self | None) -> None:
+        walls = self._grid.walls
+        passable = ~walls
+        width, height = walls.shape
+        self._directions = np.zeros((width, height, 2), dtype=np.int8)
+
+        goal_x, goal_y = self._grid.to_grid(*self._goal)
+        if not self._grid.in_bounds(goal_x, goal_y) or walls[goal_x, goal_y]:
+            self._flat = None
+            self._distances = np.full(walls.shape, UNREACHABLE,
+                                      dtype=np.int32)
+            return
+        start = self._grid.to_flat(goal_x, goal_y)
+
+        if (previous != None and previous._flat != None
+            and previous._passable is self._passable
+            and previous._flat[start] != UNREACHABLE):
+            # going through the old goal is never shorter than the real
+            # path, so old distances plus the distance between the goals are
+            # an upper bound; only tiles that beat it (which always chain
+            # back to the new goal) get revisited
+            moved = int(previous._flat[start])
+            flat = np.array(previous._flat)
+            flat[flat != UNREACHABLE] += moved
+            flat = flat.tolist()
+        else:
+            flat = [UNREACHABLE] * len(self._grid._passable)
+        flat[start] = 0
+        self._bfs(flat, start)
+        self._flat = flat
+        self._distances = np.array(flat, dtype=np.int32).reshape(
+            width + 2, height + 2
+        )[1:-1, 1:-1]
+
+        # each tile points at its lowest neighbour; diagonals are only
+        # allowed when both straight tiles beside them are open, so
+        # entities don't clip corners
+        distances = self._distances
+        best = distances.copy()
+        for dx, dy in DIRECTIONS:
+            neighbour = _shift(distances, dx, dy, UNREACHABLE)
+            if dx and dy:
+                open_x = _shift(passable, dx, 0, False)
+                open_y = _shift(passable, 0, dy, False)
+                neighbour = np.where(open_x & open_y, neighbour, UNREACHABLE)
+            better = neighbour < best
+            best[better] = neighbour[better]
+            self._directions[better] = (dx, dy)
+        # walls and tiles cut off from the goal don't go anywhere
+        self._directions[~passable | (distances == UNREACHABLE)] = 0
+
+    def _bfs(self: Self, flat: list, start: int) -> None:
+        # plain FIFO BFS over the padded flat grid; a tile is only queued
+        # when it gets closer, so this also fixes up a reused field
+        passable = self._grid._passable
+        stride = self._grid.stride
+        queue = deque((start,))
+        popleft = queue.popleft
+        append = queue.append
+        while queue:
+            tile = popleft()
+            step = flat[tile] + 1
+            # unrolled for the 4 straight neighbours
+            for neighbour in (tile + 1, tile - 1,
+                              tile + stride, tile - stride):
+                if step < flat[neighbour] and passable[neighbour]:
+                    flat[neighbour] = step
+                    append(neighbour)
+
+    def distance(self: Self, pos: Point) -> Real:
+        grid_x, grid_y = self._grid.to_grid(pos[0], pos[1])
+        if not self._grid.in_bounds(grid_x, grid_y):
+            return UNREACHABLE
+        return int(self._distances[grid_x, grid_y])
+
+    def direction(self: Self, pos: Point) -> pg.Vector2:
+        grid_x, grid_y = self._grid.to_grid(pos[0], pos[1])
+        if not self._grid.in_bounds(grid_x, grid_y):
+            return pg.Vector2(0, 0)
+        direction = pg.Vector2(*self._directions[grid_x, grid_y].tolist())
+        if direction:
+            direction.normalize_ip()
+        return direction
+
+    def lookup(self: Self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        # one gather for a whole crowd; returns unnormalized (n, 2) steps
+        grid_x, grid_y = self._grid.to_grid(np.asarray(xs), np.asarray(ys))
+        inside = self._grid.in_bounds(grid_x, grid_y)
+        steps = np.zeros((*grid_x.shape, 2), dtype=np.int8)
+        steps[inside] = self._directions[grid_x[inside], grid_y[inside]]
+        return steps
+
+
+class Navigator(object):
+    def __init__(self: Self,
+                 level: dict,
+                 target: Entity | None=None,
+                 cache_size: int=16,
+                 threaded: bool=1) -> None:
+        self._grid = NavigationGrid(level)
+        self._fields = OrderedDict()
+        self._field = None
+        self._builder = None
+        self._built = None
+        self.cache_size = cache_size
+        self.threaded = threaded
+        self.target = target
+
+    @property
+    def grid(self: Self) -> NavigationGrid:
+        return self._grid
+
+    @property
+    def target(self: Self) -> Entity | None:
+        return self._target
+
+    @target.setter
+    def target(self: Self, value: Entity | None) -> None:
+        self._target = value
+        self._field = None
+
+    @property
+    def cache_size(self: Self) -> int:
+        return self._cache_size
+
+    @cache_size.setter
+    def cache_size(self: Self, value: int) -> None:
+        self._cache_size = max(int(value), 1)
+        while len(self._fields) > self._cache_size:
+            self._fields.popitem(last=0)
+
+    @property
+    def threaded(self: Self) -> bool:
+        return bool(self._threaded)
+
+    @threaded.setter
+    def threaded(self: Self, value: bool) -> None:
+        # builds fields off the frame thread, steering with the old field
+        # until the new one is ready
+        self._threaded = value
+
+    @property
+    def field(self: Self) -> FlowField | None:
+        return self._field
+
+    def invalidate(self: Self) -> None:
+        # call after editing level['walls']
+        if self._builder != None:
+            self._builder.join()
+            self._builder = None
+        self._grid.rebuild()
+        self._fields.clear()
+        self._field = None
+        self._built = None
+
+    def _cache(self: Self, field: FlowField) -> None:
+        self._fields[f'{field.goal[0]};{field.goal[1]}'] = field
+        while len(self._fields) > self._cache_size:
+            self._fields.popitem(last=0)
+
+    def get_field(self: Self, goal: Point) -> FlowField:
+        # builds synchronously on a miss, from the current field if possible
+        key = f'{math.floor(goal[0])};{math.floor(goal[1])}'
+        field = self._fields.get(key)
+        if field == None:
+            field = FlowField(self._grid, goal, self._field)
+            self._cache(field)
+        else:
+            self._fields.move_to_end(key)
+        return field
+
+    def _build(self: Self, goal: tuple, previous: FlowField | None) -> None:
+        self._built = FlowField(self._grid, goal, previous)
+
+    def update(self: Self) -> None:
+        # only does work when the target crosses into another tile
+        if self._builder != None and not self._builder.is_alive():
+            self._builder = None
+            if self._built != None:
+                self._cache(self._built)
+                self._field = self._built
+                self._built = None
+        if self._target == None:
+            self._field = None
+            return
+        goal = (math.floor(self._target.x), math.floor(self._target.y))
+        if self._field != None and self._field.goal == goal:
+            return
+        key = f'{goal[0]};{goal[1]}'
+        if key in self._fields:
+            self._fields.move_to_end(key)
+            self._field = self._fields[key]
+        elif not self._threaded or self._field == None:
+            self._field = self.get_field(goal)
+        elif self._builder == None:
+            # a goal that moves again while this runs is picked up by the
+            # next update once it's done
+            self._builder = Thread(target=self._build,
+                                   args=(goal, self._field),
+                                   daemon=1)
+            self._builder.start()
+
+    def steer(self: Self, entities: Sequence[Entity], speed: Real) -> None:
+        if self._field == None or not entities:
+            return
+        xs = np.fromiter((entity.x for entity in entities), dtype=float,
+                         count=len(entities))
+        ys = np.fromiter((entity.y for entity in entities), dtype=float,
+                         count=len(entities))
+        steps = self._field.lookup(xs, ys).astype(float)
+        lengths = np.hypot(steps[:, 0], steps[:, 1])
+        lengths[lengths == 0] = 1
+        steps *= (speed / lengths)[:, None]
+        for entity, step in zip(entities, steps.tolist()):
+            entity.velocity2d = step
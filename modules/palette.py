@@ -0,0 +1,141 @@
+from typing import Self
+from collections.abc import Sequence
+
+import numpy as np
+import pygame as pg
+
+
+def _nearest(colors: np.ndarray, palette: np.ndarray) -> np.ndarray:
+    # index of the closest palette entry for every color, done in chunks so
+    # the distance matrix stays small
+    colors = colors.astype(np.int32)
+    palette = palette.astype(np.int32)
+    indices = np.empty(len(colors), dtype=np.uint8)
+    for start in range(0, len(colors), 4096):
+        chunk = colors[start:start + 4096]
+        distances = ((chunk[:, None, :] - palette[None, :, :])**2).sum(axis=2)
+        indices[start:start + 4096] = distances.argmin(axis=1)
+    return indices
+
+
+def _box_range(colors: np.ndarray, box: np.ndarray) -> tuple:
+    # how wide a box's widest channel is and which channel (-1 if it can't
+    # be split)
+    if len(box) < 2:
+        return -1, 0
+    ranges = np.ptp(colors[box], axis=0)
+    channel = int(ranges.argmax())
+    return int(ranges[channel]), channel
+
+
+def _median_cut(colors: np.ndarray,
+                counts: np.ndarray,
+                amount: int) -> np.ndarray:
+    # each box keeps its range, so a split only measures the two new halves
+    boxes = [np.arange(len(colors))]
+    ranges = [_box_range(colors, boxes[0])]
+    while len(boxes) < amount:
+        # split the box with the widest channel at its weighted median
+        widest = max(range(len(boxes)), key=lambda dex: ranges[dex][0])
+        if ranges[widest][0] <= 0:
+            break
+        box = boxes.pop(widest)
+        channel = ranges.pop(widest)[1]
+        box = box[np.argsort(colors[box, channel], kind='stable')]
+        cumulative = np.cumsum(counts[box])
+        split = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+        split = min(max(split, 1), len(box) - 1)
+        for half in (box[:split], box[split:]):
+            boxes.append(half)
+            ranges.append(_box_range(colors, half))
+    return np.array([
+        np.average(colors[box], axis=0, weights=counts[box])
+        for box in boxes
+    ]).round().astype(np.uint8)
+
+
+def _add_to_bins(counts: np.ndarray,
+                 sums: np.ndarray,
+                 colors: np.ndarray,
+                 weights: object) -> None:
+    # 5 bits per channel packed into one int, so 32768 bins at most
+    binned = np.clip(colors.round(), 0, 255).astype(np.int32) >> 3
+    keys = binned[:, 0] << 10 | binned[:, 1] << 5 | binned[:, 2]
+    weights = np.broadcast_to(weights, len(keys))
+    counts += np.bincount(keys, weights=weights, minlength=32768)
+    for channel in range(3):
+        sums[:, channel] += np.bincount(
+            keys, weights=colors[:, channel] * weights, minlength=32768,
+        )
+
+
+class Palette(object):
+    def __init__(self: Self,
+                 surfs: Sequence[pg.Surface],
+                 light_levels: int=32) -> None:
+        # index 0 is always black so that unlit/empty pixels need no lookup
+        pixels = np.concatenate([
+            pg.surfarray.array3d(surf).reshape(-1, 3) for surf in surfs
+        ]) if surfs else np.zeros((1, 3), dtype=np.uint8)
+        # colors are binned to 5 bits per channel (keeping the average of
+        # each bin), which caps how many the median cut has to sort no matter
+        # how big or noisy the textures are
+        counts = np.zeros(32768)
+        sums = np.zeros((32768, 3))
+        _add_to_bins(counts, sums, pixels.astype(float), 1)
+        keys = np.nonzero(counts)[0]
+        colors = sums[keys] / counts[keys, None]
+        weights = counts[keys]
+        # a few darker copies of every color get a share of the palette too,
+        # so the colormap rows have something close to land on
+        for factor in (0.25, 0.5, 0.75):
+            _add_to_bins(counts, sums, colors * factor, weights / 4)
+        keys = np.nonzero(counts)[0]
+        counts = counts[keys]
+        colors = sums[keys] / counts[:, None]
+        colors = _median_cut(colors, counts, 255)
+        self._colors = np.zeros((len(colors) + 1, 3), dtype=np.uint8)
+        self._colors[1:] = colors
+        self.light_levels = light_levels
+
+    @property
+    def colors(self: Self) -> np.ndarray:
+        return self._colors
+
+    @property
+    def colormaps(self: Self) -> np.ndarray:
+        return self._colormaps
+
+    @property
+    def light_levels(self: Self) -> int:
+        return self._light_levels
+
+    @light_levels.setter
+    def light_levels(self: Self, value: int) -> None:
+        # row n maps every index to its closest color at n / (levels - 1)
+        # brightness, so lighting is a table lookup instead of a multiply
+        self._light_levels = max(int(value), 2)
+        factors = np.linspace(0, 1, num=self._light_levels)
+        shaded = self._colors[None, :, :] * factors[:, None, None]
+        self._colormaps = _nearest(
+            shaded.reshape(-1, 3).round(), self._colors
+        ).reshape(self._light_levels, len(self._colors))
+
+    def quantize(self: Self, surf: pg.Surface) -> np.ndarray:
+        # (width, height) uint8 array of palette indices
+        pixels = pg.surfarray.array3d(surf)
+        colors, inverse = np.unique(pixels.reshape(-1, 3), axis=0,
+                                    return_inverse=True)
+        indices = _nearest(colors, self._colors)[inverse.reshape(-1)]
+        return indices.reshape(pixels.shape[:2])
+
+    def light(self: Self, brightness: object) -> object:
+        # brightness in [0, 1] to a colormap row
+        return np.rint(
+            np.clip(brightness, 0, 1) * (self._light_levels - 1)
+        ).astype(int)
+
+    def make_surface(self: Self, size: tuple) -> pg.Surface:
+        surf = pg.Surface(size, depth=8)
+        surf.set_palette([tuple(color) for color in self._colors.tolist()])
+        return surf
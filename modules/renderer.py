@@ -13,6 +13,7 @@ from modules.texture import WallTexture
 from modules.texture import FloorTexture
 from modules.entities import Player
 from modules.entities import EntityManager
+from modules.palette import Palette
 
 
 class Camera(object):
@@ -24,7 +25,8 @@ class Camera(object):
                  floor_texture: FloorTexture,
                  player: Player,
                  bob_strength: Real=0.075,
-                 bob_frequency: Real=10) -> None:
+                 bob_frequency: Real=10,
+                 palette: Palette | None=None) -> None:
         
         try:
             self._yaw_magnitude = float(1 / math.tan(math.radians(fov) / 2))
@@ -38,9 +40,13 @@ class Camera(object):
         self._wall_render_distance = wall_render_distance
         self._wall_textures = wall_textures
         self._floor_texture = floor_texture
+        self._ray_ends = ()
+        self._frame_surf = None
+        self._height_level = None
 
         self.bob_strength = bob_strength
         self.bob_frequency = bob_frequency
+        self.palette = palette
 
     @property
     def bob_strength(self: Self) -> Real:
@@ -70,6 +76,7 @@ class Camera(object):
         self._player._settings['bob_frequency'] = 0
         self._player._settings['bob_strength'] = 0
         self._player = value
+        self._height_level = None
         value._settings['bob_frequency'] = self._bob_frequency
         value._settings['bob_strength'] = self._bob_strength
 
@@ -111,6 +118,95 @@ class Camera(object):
     def wall_render_distance(self: Self, value: Real) -> None:
         self._wall_render_distance = value
 
+    @property
+    def palette(self: Self) -> Palette | None:
+        return self._palette
+
+    @palette.setter
+    def palette(self: Self, value: Palette | None) -> None:
+        # None renders in RGB; otherwise textures are quantized once here
+        # and frames are drawn as palette indices
+        self._palette = value
+        self._frame_surf = None
+        self._indexed_floor = None
+        if value != None:
+            # walls are stacked (padded to the biggest one) so a whole frame
+            # of columns can be gathered with one index
+            walls = [value.quantize(texture.surf)
+                     for texture in self._wall_textures]
+            self._indexed_wall_sizes = np.array([wall.shape
+                                                 for wall in walls])
+            self._indexed_wall_stack = np.zeros(
+                (len(walls), *self._indexed_wall_sizes.max(axis=0)),
+                dtype=np.uint8,
+            )
+            for dex, wall in enumerate(walls):
+                self._indexed_wall_stack[dex, :wall.shape[0],
+                                         :wall.shape[1]] = wall
+            self._indexed_floor = value.quantize(self._floor_texture.surf)
+
+    def refresh_heights(self: Self) -> None:
+        # call after editing the level's 'heights' or 'floor_offsets'; it is
+        # also done automatically when the player's level changes
+        level = self._player._level
+        self._height_level = level
+        # optional per-tile wall heights and floor offsets (in tiles), plus
+        # the top of the tallest wall, which bounds what can show over walls
+        self._wall_heights = level.get('heights', {})
+        self._floor_offsets = level.get('floor_offsets', {})
+        self._max_wall_top = max([1] + [
+            self._floor_offsets.get(tile_key, 0) + wall_height
+            for tile_key, wall_height in self._wall_heights.items()
+        ] + [
+            floor_offset + self._wall_heights.get(tile_key, 1)
+            for tile_key, floor_offset in self._floor_offsets.items()
+        ])
+
+    @property
+    def ray_ends(self: Self) -> tuple:
+        # where each column's ray stopped last frame, in world coordinates
+        return self._ray_ends
+
+    def _floor_coords(self: Self,
+                      width: Real,
+                      amount_of_offsets: Real,
+                      horizon: Real,
+                      texture_size: tuple) -> tuple:
+        rays = (self._yaw - self._player._semiplane,
+                self._yaw + self._player._semiplane)
+        x_pixels = np.linspace(0, width, num=width, endpoint=0) 
+        x_pixels = np.vstack(x_pixels) # all x values
+        offsets = np.linspace(
+            max(-horizon, 1),
+            amount_of_offsets + max(-horizon, 0),
+            num=amount_of_offsets,
+            endpoint=0
+        ) # offsets from horizon to render
+        
+        # takes into account elevation
+        # basically, some of the vertical camera plane is below the ground
+        # intersection between ground and ray is behind the plane
+        # (not in front); we use this multiplier
+        mult = self._tile_size / 2 * (1 + self._player._render_elevation)
+        start_points_x = mult / offsets * rays[0][0]
+        start_points_y = mult / offsets * rays[0][1]
+
+        end_points_x = mult / offsets * rays[1][0]
+        end_points_y = mult / offsets * rays[1][1]
+
+        step_x = (end_points_x - start_points_x) / width
+        step_y = (end_points_y - start_points_y) / width
+        
+        x_points = self._player._pos.x + start_points_x + step_x * x_pixels
+        y_points = self._player._pos.y + start_points_y + step_y * x_pixels
+        
+        # change the multiplier before the mod to change size of texture
+        texture_xs = np.floor(x_points * 1 % 1 * texture_size[0])
+        texture_ys = np.floor(y_points * 1 % 1 * texture_size[1])
+        texture_xs = texture_xs.astype('int')
+        texture_ys = texture_ys.astype('int')
+        return texture_xs, texture_ys, offsets
+
     def _render_floor_and_ceiling(self: Self,
                                   width: Real,
                                   height: Real,
@@ -122,132 +218,348 @@ class Camera(object):
         self._floor_and_ceiling = 0 
 
         if difference >= 1:
-            self._floor_and_ceiling = pg.Surface((width, amount_of_offsets))
-            rays = (self._yaw - self._player._semiplane,
-                    self._yaw + self._player._semiplane)
-            x_pixels = np.linspace(0, width, num=width, endpoint=0) 
-            x_pixels = np.vstack(x_pixels) # all x values
-            offsets = np.linspace(
-                max(-horizon, 1),
-                amount_of_offsets + max(-horizon, 0),
-                num=amount_of_offsets,
-                endpoint=0
-            ) # offsets from horizon to render
-            
-            # takes into account elevation
-            # basically, some of the vertical camera plane is below the ground
-            # intersection between ground and ray is behind the plane
-            # (not in front); we use this multiplier
-            mult = self._tile_size / 2 * (1 + self._player._render_elevation)
-            start_points_x = mult / offsets * rays[0][0]
-            start_points_y = mult / offsets * rays[0][1]
-
-            end_points_x = mult / offsets * rays[1][0]
-            end_points_y = mult / offsets * rays[1][1]
-
-            step_x = (end_points_x - start_points_x) / width
-            step_y = (end_points_y - start_points_y) / width
-            
-            x_points = self._player._pos.x + start_points_x + step_x * x_pixels
-            y_points = self._player._pos.y + start_points_y + step_y * x_pixels
-            
             texture = self._floor_texture
-            # change the multiplier before the mod to change size of texture
-            texture_xs = np.floor(x_points * 1 % 1 * texture.width)
-            texture_ys = np.floor(y_points * 1 % 1 * texture.height)
-            texture_xs = texture_xs.astype('int')
-            texture_ys = texture_ys.astype('int')
+            texture_xs, texture_ys, offsets = self._floor_coords(
+                width,
+                amount_of_offsets,
+                horizon,
+                (texture.width, texture.height),
+            )
+
+            if self._palette != None:
+                # lighting is a colormap row per offset instead of a
+                # float multiply per channel
+                floor = self._indexed_floor[texture_xs, texture_ys]
+                lights = self._palette.light(
+                    np.minimum(offsets / (height / 2), 1)**0.97
+                )
+                self._floor_and_ceiling = (
+                    self._palette.colormaps[lights[None, :], floor]
+                )
+                return
 
             floor = texture[texture_xs, texture_ys]
             # lighting
             offsets = np.vstack(offsets)
             floor = floor * np.minimum(offsets / (height / 2), 1)**0.97
             # can't do *= ^
-            pg.surfarray.blit_array(self._floor_and_ceiling, floor)
+            self._floor_and_ceiling = floor
+
+    def _cast_ray(self: Self,
+                  ray: pg.Vector2,
+                  height: Real,
+                  horizon: Real) -> tuple:
+        mag = ray.magnitude()
+
+        walls = self._player._level['walls']
+        wall_heights = self._wall_heights
+        floor_offsets = self._floor_offsets
+        elevation = self._player._render_elevation
+        tile_size = self._tile_size
+        max_wall_top = self._max_wall_top
+        hits = []
+        end_pos = self._player._pos.copy()
+        slope = ray.y / ray.x if ray.x else math.inf
+        tile = pg.Vector2(math.floor(end_pos.x), math.floor(end_pos.y))
+        dir = (ray.x > 0, ray.y > 0)
+        rel_depth = 0 # relative to yaw magnitude
+        dist = 0 
+        # rows of this column that nothing has covered yet
+        open_top = 0
+        open_bottom = height
+        # keep on changing end_pos until the column is covered (DDA)
+        while open_top < open_bottom and dist < self._wall_render_distance:
+            # displacements until hit tile
+            disp_x = tile.x + dir[0] - end_pos.x
+            disp_y = tile.y + dir[1] - end_pos.y
+            # step for tile (for each displacement)
+            step_x = dir[0] * 2 - 1 # 1 if yes, -1 if no
+            step_y = dir[1] * 2 - 1 
+            # relative lengths of each semiray
+            len_x = abs(disp_x / ray.x) if ray.x else math.inf
+            len_y = abs(disp_y / ray.y) if ray.y else math.inf
+            if len_x < len_y:
+                tile.x += step_x
+                end_pos.x += disp_x
+                end_pos.y += disp_x * slope
+                rel_depth += len_x
+                side = 1
+            else:
+                tile.y += step_y
+                end_pos.x += disp_y / slope if slope else math.inf
+                end_pos.y += disp_y
+                rel_depth += len_y
+                side = 0
+            dist = rel_depth * mag
+            
+            tile_key = f'{int(tile.x)};{int(tile.y)}'
+            if walls.get(tile_key) == None or not rel_depth:
+                continue
+
+            # distance already does fisheye correction because it divides
+            # by the magnitude of ray
+            line_height = min(tile_size / rel_depth, height * 5)
+            # elevation offset
+            offset = elevation * tile_size / 2 / rel_depth
+            # a wall of height 1 spans one line_height, centered on the
+            # horizon when it starts at the floor
+            floor_offset = (floor_offsets.get(tile_key, 0)
+                            if floor_offsets else 0)
+            wall_height = wall_heights.get(tile_key, 1) if wall_heights else 1
+            if wall_height <= 0 or floor_offset + wall_height <= 0:
+                # flat or buried walls have nothing to draw and hide nothing
+                continue
+            top = (horizon
+                   - line_height * (floor_offset + wall_height - 0.5)
+                   + offset)
+            bottom = horizon - line_height * (floor_offset - 0.5) + offset
+            base = horizon + line_height / 2 + offset # screen y of the floor
+            # +2 to avoid pixel glitches at edges of wall
+            visible_top = math.floor(top)
+            if visible_top < open_top:
+                visible_top = open_top
+            # walls sunk below the floor (negative offsets) are cut off at
+            # the floor, so they look like shorter walls standing on it
+            visible_bottom = math.floor(min(bottom, base)) + 2
+            if visible_bottom > open_bottom:
+                visible_bottom = open_bottom
+            if visible_top < visible_bottom:
+                hits.append((
+                    dist,
+                    end_pos[side] % 1,
+                    walls[tile_key],
+                    base,
+                    line_height,
+                    floor_offset,
+                    wall_height,
+                    top,
+                    visible_top,
+                    visible_bottom,
+                ))
+
+            if (floor_offset <= 0
+                and floor_offset + wall_height >= max_wall_top
+                and top < horizon):
+                # nothing further away can show over or under it (this is
+                # every hit in levels without heights)
+                break
+            # shrink the open rows by what this wall hides; a wall floating
+            # in the middle of them is drawn but can't shrink them
+            if floor_offset <= 0:
+                # the floor in front of it hides everything below
+                if top < open_bottom:
+                    open_bottom = math.floor(top)
+            else:
+                if top <= open_top < bottom:
+                    open_top = math.floor(bottom)
+                # anything further away stands on floor above this one
+                if base < open_bottom:
+                    open_bottom = math.ceil(base)
+            # and is no taller than the tallest wall, whose top approaches
+            # the horizon with distance
+            ceiling = min(base - line_height * max_wall_top, horizon)
+            if ceiling > open_top:
+                open_top = math.floor(ceiling)
+        return hits, end_pos
 
     def _render_walls_and_entities(self: Self,
                                    width: Real,
                                    height: Real,
                                    horizon: Real) -> None:
-        # the per-pixel alpha with (0, 0, 0, 0) doesn't seem to affect
-        # fps at all
-        self._walls_and_entities = pg.Surface((width, height), pg.SRCALPHA)
-        self._walls_and_entities.fill((0, 0, 0, 0))
+        if self._palette != None:
+            self._render_indexed_walls(width, height, horizon)
+            return
+        # lines are blitted straight onto the target once the floor is in,
+        # so only their positions are kept here
+        self._walls_and_entities = []
+        blits = self._walls_and_entities
+        # rows drawn for the nearest hit of each column, and for any hits
+        # behind it (only there when walls of other heights are in view)
+        tops = [0] * width
+        bottoms = [0] * width
+        behind = []
+        ray_ends = []
         # Wall Casting
         for x in range(width):
             ray = self._yaw + self._player._semiplane * (2 * x / width - 1)
-            mag = ray.magnitude()
-
-            has_hit = 0
-            end_pos = self._player._pos.copy()
-            slope = ray.y / ray.x if ray.x else math.inf
-            tile = pg.Vector2(math.floor(end_pos.x), math.floor(end_pos.y))
-            dir = (ray.x > 0, ray.y > 0)
-            rel_depth = 0 # relative to yaw magnitude
-            dist = 0 
-            # keep on changing end_pos until hitting a wall (DDA)
-            while not has_hit and dist < self._wall_render_distance:
-                # displacements until hit tile
-                disp_x = tile.x + dir[0] - end_pos.x
-                disp_y = tile.y + dir[1] - end_pos.y
-                # step for tile (for each displacement)
-                step_x = dir[0] * 2 - 1 # 1 if yes, -1 if no
-                step_y = dir[1] * 2 - 1 
-                # relative lengths of each semiray
-                len_x = abs(disp_x / ray.x) if ray.x else math.inf
-                len_y = abs(disp_y / ray.y) if ray.y else math.inf
-                if len_x < len_y:
-                    tile.x += step_x
-                    end_pos.x += disp_x
-                    end_pos.y += disp_x * slope
-                    rel_depth += len_x
-                    side = 1
+            hits, end_pos = self._cast_ray(ray, height, horizon)
+            ray_ends.append((end_pos.x, end_pos.y))
+            # furthest first so nearer walls end up on top
+            for layer in range(len(hits) - 1, -1, -1):
+                (dist, wall_x, texture, base, line_height, floor_offset,
+                 wall_height, top, visible_top, visible_bottom) = hits[layer]
+                texture = self._wall_textures[texture]
+                line = pg.transform.scale(
+                    texture[math.floor(wall_x * texture.width)],
+                    (1, line_height + 2)
+                )
+                pg.transform.hsl(line, 0, 0, max(-dist / 6, -1), line)
+                if floor_offset <= 0 and floor_offset + wall_height == 1:
+                    # ordinary one tile wall (or one sunk down to that)
+                    line_top = int(top)
+                    start = max(line_top, visible_top)
+                    end = min(line_top + line.height, visible_bottom)
+                    if start < end:
+                        blits.append((
+                            line,
+                            (x, start),
+                            pg.Rect(0, start - line_top, 1, end - start),
+                        ))
                 else:
-                    tile.y += step_y
-                    end_pos.x += disp_y / slope if slope else math.inf
-                    end_pos.y += disp_y
-                    rel_depth += len_y
-                    side = 0
-                dist = rel_depth * mag
-                
-                tile_key = f'{int(tile.x)};{int(tile.y)}'
-                has_hit = (self._player._level['walls'].get(tile_key) != None 
-                           and rel_depth)
-            if has_hit:
-                # distance already does fisheye correction because it divides
-                # by the magnitude of ray
-                line_height = min(self._tile_size / rel_depth, height * 5)
-                # elevation offset
-                offset = (self._player._render_elevation
-                          * self._tile_size / 2 / rel_depth)
-                # check if line is visible
-                if (-line_height / 2 - offset < horizon 
-                    < height + line_height / 2 - offset):
-                    texture = self._player._level['walls'][tile_key]
-                    dex = math.floor(end_pos[side] % 1
-                                     * self._wall_textures[texture].width)
-                    line = pg.transform.scale(
-                        self._wall_textures[texture][dex],
-                        (1, line_height + 2)
-                    )
-                    # ^ +2 to avoid pixel glitches at edges of wall
-                    pg.transform.hsl(line, 0, 0, max(-dist / 6, -1), line)
-
-                    self._walls_and_entities.blit(
-                        line, (x, horizon - line_height / 2 + offset),
-                    )
+                    # the texture repeats once per tile of height, so tall
+                    # walls are several blits of the same line
+                    # bands under the floor never show
+                    first = max(math.floor(floor_offset), 0)
+                    last = math.ceil(floor_offset + wall_height - 1e-9) - 1
+                    start = height
+                    end = 0
+                    for band in range(last, first - 1, -1):
+                        band_top = int(top + line_height * (
+                            floor_offset + wall_height - band - 1
+                        ))
+                        band_start = max(band_top, visible_top)
+                        band_end = min(band_top + line.height, visible_bottom)
+                        if band_start < band_end:
+                            blits.append((
+                                line,
+                                (x, band_start),
+                                pg.Rect(0, band_start - band_top,
+                                        1, band_end - band_start),
+                            ))
+                            start = min(start, band_start)
+                            end = max(end, band_end)
+                if layer:
+                    behind.append((x, start, end))
+                elif start < end:
+                    tops[x] = start
+                    bottoms[x] = end
+        self._ray_ends = tuple(ray_ends)
+        rows = np.arange(height)[None, :]
+        self._covered = ((rows >= np.array(tops)[:, None])
+                         & (rows < np.array(bottoms)[:, None]))
+        for x, start, end in behind:
+            self._covered[x, start:end] = 1
+
+    def _render_indexed_walls(self: Self,
+                              width: Real,
+                              height: Real,
+                              horizon: Real) -> None:
+        # same casting as above, but hits are only measured here; the pixels
+        # are written a layer (nth hit of every column) at a time afterwards
+        layers = [] # the hits from _cast_ray, as rows of numbers
+        ray_ends = []
+        for x in range(width):
+            ray = self._yaw + self._player._semiplane * (2 * x / width - 1)
+            hits, end_pos = self._cast_ray(ray, height, horizon)
+            ray_ends.append((end_pos.x, end_pos.y))
+            for layer, hit in enumerate(hits):
+                if layer == len(layers):
+                    layers.append([(0,) * 10] * width)
+                layers[layer][x] = hit
+        self._ray_ends = tuple(ray_ends)
+
+        rows = np.arange(height)[None, :]
+        self._walls_and_entities = np.zeros((width, height), dtype=np.uint8)
+        self._covered = np.zeros((width, height), dtype=bool)
+        # furthest first so nearer walls end up on top
+        for columns in reversed(layers):
+            columns = np.array(columns, dtype=float)
+            textures = columns[:, 2].astype(int)
+            bases = columns[:, 3:4]
+            line_heights = np.maximum(columns[:, 4:5], 1e-9)
+            floor_offsets = columns[:, 5:6]
+            tops = columns[:, 7:8]
+            covered = (rows >= columns[:, 8:9]) & (rows < columns[:, 9:10])
+            sizes = self._indexed_wall_sizes[textures]
+            if np.all((floor_offsets <= 0)
+                      & (floor_offsets + columns[:, 6:7] == 1)
+                      | (columns[:, 9:10] == 0)):
+                # ordinary one tile walls, stretched with the +2 padding
+                texture_ys = np.floor((rows - tops)
+                                      / (line_heights + 2) * sizes[:, 1:2])
+            else:
+                # height above the floor of every row, kept inside the wall
+                # so the +2 padding repeats its bottom row; the texture
+                # repeats once per tile of height
+                heights = np.clip((bases - rows) / line_heights,
+                                  np.maximum(floor_offsets, 0),
+                                  (bases - tops) / line_heights - 1e-6)
+                texture_ys = np.floor((1 - heights % 1) * sizes[:, 1:2])
+            dexes = np.floor(columns[:, 1] * sizes[:, 0]).astype(int)
+            texture_ys = np.clip(texture_ys.astype(int),
+                                 0, sizes[:, 1:2] - 1)
+            indices = self._indexed_wall_stack[
+                textures[:, None], dexes[:, None], texture_ys
+            ]
+            lights = self._palette.light(1 - columns[:, 0:1] / 6)
+            if len(layers) == 1:
+                self._walls_and_entities = (
+                    self._palette.colormaps[lights, indices]
+                )
+                self._covered = covered
+                break
+            np.copyto(self._walls_and_entities,
+                      self._palette.colormaps[lights, indices],
+                      where=covered)
+            self._covered |= covered
+
+    def _fill_background(self: Self,
+                         target: np.ndarray,
+                         uncovered: np.ndarray,
+                         horizon: Real) -> None:
+        # floor below the horizon and black everywhere else, skipping any
+        # pixel a wall is going to cover
+        floor_start = floor_end = max(0, int(horizon))
+        if isinstance(self._floor_and_ceiling, np.ndarray):
+            floor_end = floor_start + self._floor_and_ceiling.shape[1]
+            np.copyto(target[:, floor_start:floor_end],
+                      self._floor_and_ceiling,
+                      casting='unsafe',
+                      where=uncovered[:, floor_start:floor_end])
+        np.copyto(target[:, :floor_start], 0,
+                  where=uncovered[:, :floor_start])
+        np.copyto(target[:, floor_end:], 0, where=uncovered[:, floor_end:])
+
+    def _present(self: Self, surf: pg.Surface, horizon: Real) -> None:
+        # floor is written into the target's own pixels, then the wall lines
+        # go on top, so every pixel is written once and nothing full-size
+        # is allocated
+        pixels = pg.surfarray.pixels3d(surf)
+        self._fill_background(pixels, ~self._covered[:, :, None], horizon)
+        del pixels # unlocks surf
+        surf.blits(self._walls_and_entities, doreturn=0)
+
+    def _present_indexed(self: Self,
+                         surf: pg.Surface,
+                         width: Real,
+                         height: Real,
+                         horizon: Real) -> None:
+        # the frame array and 8-bit surface are kept between frames
+        if self._frame_surf == None or self._frame_surf.size != (width,
+                                                                 height):
+            self._frame_surf = self._palette.make_surface((width, height))
+            self._frame = np.zeros((width, height), dtype=np.uint8)
+        frame = self._frame
+        np.copyto(frame, self._walls_and_entities, where=self._covered)
+        self._fill_background(frame, ~self._covered, horizon)
+
+        # palette expansion happens once, in this blit
+        pg.surfarray.blit_array(self._frame_surf, frame)
+        surf.blit(self._frame_surf, (0, 0))
     
     def render(self: Self, surf: pg.Surface) -> None:
         width = surf.width
         height = surf.height
 
-        surf.fill((0, 0, 0))
         self._yaw = self._player._yaw * self._yaw_magnitude
  
         horizon = self._horizon
         if self._horizon == None:
             horizon = int(height / 2)
 
+        if self._player._level is not self._height_level:
+            self.refresh_heights()
+
         floor_and_ceiling = Thread(
             target=self._render_floor_and_ceiling,
             args=(width, height, horizon),
@@ -261,7 +573,7 @@ class Camera(object):
         floor_and_ceiling.join()
         walls_and_entities.join()
 
-        if self._floor_and_ceiling:
-            surf.blit(self._floor_and_ceiling, (0, max(0, horizon)))
-        surf.blit(self._walls_and_entities, (0, 0))
-
+        if self._palette != None:
+            self._present_indexed(surf, width, height, horizon)
+        else:
+            self._present(surf, horizon)